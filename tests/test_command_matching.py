@@ -19,10 +19,54 @@ def vc():
     ("fan on please", "fan/on"),
     ("turn everything on", "all/on"),
     ("can you turn everything off", "all/off"),
+    ("turn all the devices on", "all/on"),
+    ("switch all the lights off", "all/off"),
+    ("could you turn all of the lights on", "all/on"),
 ])
 def test_match_simple(vc, phrase, expected):
+    # listen_once hands over lowercased text
+    assert vc._match_command(phrase.lower()) == expected
+
+
+@pytest.mark.parametrize("phrase,expected", [
+    # Plural device nouns
+    ("turn on lights", "light/on"),
+    ("turn off lights", "light/off"),
+    ("turn on leds", "led/on"),
+    ("turn on fans", "fan/on"),
+    ("projectors off", "projector/off"),
+    # Punctuation from the recognizer
+    ("fan on, please", "fan/on"),
+    ("led on.", "led/on"),
+    ("turn the lights off.", "light/off"),
+    ("turn all the lights on!", "all/on"),
+    # Common mishearings are aliased while tokenizing
+    ("fan one", "fan/on"),
+])
+def test_match_normalized(vc, phrase, expected):
+    assert vc._match_command(phrase) == expected
+
+
+@pytest.mark.parametrize("phrase,expected", [
+    ("fan off and turn everything on", "fan/off"),
+    ("turn everything on and fan off", "all/on"),
+    ("light on then projector off", "light/on"),
+    ("turn the light on and switch all fans off", "light/on"),
+    ("switch all fans off and turn the light on", "all/off"),
+    ("fan one and light on", "fan/on"),
+])
+def test_leftmost_command_wins(vc, phrase, expected):
     assert vc._match_command(phrase) == expected
 
 
-def test_no_match(vc):
-    assert vc._match_command("play music") is None
+@pytest.mark.parametrize("phrase", [
+    "play music",
+    "turn the hall on",
+    "open the fanfare",
+])
+def test_no_match(vc, phrase):
+    assert vc._match_command(phrase) is None
+
+
+def test_bulk_fallback_needs_words_in_order(vc):
+    assert vc._match_command("all lights switch on") is None
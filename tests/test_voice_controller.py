@@ -0,0 +1,198 @@
+import threading
+import time
+
+import pytest
+from unittest.mock import MagicMock, Mock
+
+import requests
+import speech_recognition as sr
+
+from voice_controller import (
+    DEFAULT_SAMPLE_RATE,
+    DEFAULT_TIMEOUT,
+    DEFAULT_WARMUP_TIMEOUT,
+    VoiceController,
+    parse_args,
+)
+
+
+@pytest.fixture
+def vc():
+    # Mock recognizer/mic/session so no audio device or network is touched
+    controller = VoiceController("127.0.0.1", recognizer=Mock(), mic=MagicMock())
+    controller.session = Mock()
+    yield controller
+    controller.close()
+
+
+def script(vc, outcomes):
+    """Feed recognize_google a sequence of texts/exceptions, then stop."""
+    outcomes = iter(outcomes)
+
+    def recognize(audio):
+        try:
+            outcome = next(outcomes)
+        except StopIteration:
+            vc.stop()
+            raise sr.UnknownValueError()
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    vc.recognizer.recognize_google.side_effect = recognize
+
+
+def test_sample_rate_defaults_to_16k():
+    assert parse_args(["--ip", "127.0.0.1"]).sample_rate == DEFAULT_SAMPLE_RATE
+
+
+def test_sample_rate_zero_means_device_default():
+    assert parse_args(["--sample-rate", "0"]).sample_rate == 0
+
+
+def test_negative_sample_rate_is_rejected():
+    with pytest.raises(SystemExit):
+        parse_args(["--sample-rate", "-1"])
+
+
+class FakeMicrophone:
+    """Stands in for sr.Microphone on a device that can't record at 16 kHz."""
+
+    opened = []
+
+    def __init__(self, device_index=None, sample_rate=None):
+        self.device_index = device_index
+        self.sample_rate = sample_rate
+
+    def __enter__(self):
+        FakeMicrophone.opened.append(self.sample_rate)
+        if self.sample_rate == DEFAULT_SAMPLE_RATE:
+            raise OSError(-9997, "Invalid sample rate")
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+def test_run_falls_back_to_device_rate(monkeypatch, caplog):
+    monkeypatch.setattr(sr, "Microphone", FakeMicrophone)
+    FakeMicrophone.opened = []
+    controller = VoiceController("127.0.0.1", recognizer=Mock())
+    controller.session = Mock()
+    script(controller, [])
+
+    try:
+        controller.run(ambient_duration=0)
+    finally:
+        controller.close()
+
+    assert FakeMicrophone.opened == [DEFAULT_SAMPLE_RATE, None]
+    assert "using the device default rate" in caplog.text
+
+
+def test_run_does_not_retry_an_injected_microphone(vc):
+    vc.mic.__enter__.side_effect = OSError(-9997, "Invalid sample rate")
+    with pytest.raises(OSError):
+        vc.run(ambient_duration=0)
+
+
+def test_listen_once_raises_request_error(vc):
+    vc.recognizer.recognize_google.side_effect = sr.RequestError("offline")
+    with pytest.raises(sr.RequestError):
+        vc.listen_once(Mock())
+
+
+def test_listen_once_returns_none_when_not_understood(vc):
+    vc.recognizer.recognize_google.side_effect = sr.UnknownValueError()
+    assert vc.listen_once(Mock()) is None
+
+
+def test_run_sleeps_only_after_request_error(vc, monkeypatch):
+    sleep = Mock()
+    monkeypatch.setattr("voice_controller.time.sleep", sleep)
+    script(vc, [sr.UnknownValueError(), sr.RequestError("offline"), sr.UnknownValueError()])
+
+    vc.run(ambient_duration=0, pause=0.5)
+
+    sleep.assert_called_once_with(0.5)
+
+
+def test_drain_reaps_only_finished_requests(vc, monkeypatch):
+    release = threading.Event()
+    monkeypatch.setattr(vc, "send_command", lambda path: release.wait(1) or True)
+
+    vc._dispatch("fan/on")
+    vc._drain()
+    assert len(vc._inflight) == 1
+
+    release.set()
+    vc._drain(wait=True)
+    assert not vc._inflight
+
+
+def test_next_command_waits_for_previous_requests(vc):
+    events = []
+    lock = threading.Lock()
+
+    def get(url, timeout):
+        with lock:
+            events.append(("start", url))
+        time.sleep(0.05)
+        with lock:
+            events.append(("end", url))
+        return Mock(status_code=200)
+
+    vc.session.get.side_effect = get
+    vc.warm_up = Mock()
+    script(vc, ["turn everything on", "fan off"])
+
+    vc.run(ambient_duration=0)
+
+    fan_off = events.index(("start", "http://127.0.0.1/fan/off"))
+    bulk_ends = [i for i, (kind, url) in enumerate(events) if kind == "end" and not url.endswith("/fan/off")]
+    assert len(bulk_ends) == 4
+    assert max(bulk_ends) < fan_off
+    assert events[-1] == ("end", "http://127.0.0.1/fan/off")
+
+
+def test_run_drains_requests_when_listening_fails(vc):
+    vc.recognizer.listen.side_effect = [Mock(), RuntimeError("mic unplugged")]
+    vc.recognizer.recognize_google.return_value = "fan on"
+
+    with pytest.raises(RuntimeError):
+        vc.run(ambient_duration=0)
+
+    vc.session.get.assert_any_call("http://127.0.0.1/fan/on", timeout=DEFAULT_TIMEOUT)
+    assert not vc._inflight
+
+
+def test_run_can_be_called_again_after_stop(vc):
+    script(vc, ["fan on"])
+    vc.run(ambient_duration=0)
+    script(vc, ["fan off"])
+    vc.run(ambient_duration=0)
+
+    vc.session.get.assert_any_call("http://127.0.0.1/fan/on", timeout=DEFAULT_TIMEOUT)
+    vc.session.get.assert_any_call("http://127.0.0.1/fan/off", timeout=DEFAULT_TIMEOUT)
+
+
+def test_close_waits_for_requests_and_shuts_down_pool(vc, monkeypatch):
+    shutdown = Mock(wraps=vc._pool.shutdown)
+    monkeypatch.setattr(vc._pool, "shutdown", shutdown)
+    vc._dispatch("fan/on")
+
+    vc.close()
+
+    vc.session.get.assert_called_once_with("http://127.0.0.1/fan/on", timeout=DEFAULT_TIMEOUT)
+    assert not vc._inflight
+    shutdown.assert_called_once_with()
+
+
+def test_warm_up_requests_status(vc):
+    vc.warm_up()
+    vc.session.get.assert_called_once_with("http://127.0.0.1/status", timeout=DEFAULT_WARMUP_TIMEOUT)
+
+
+def test_warm_up_ignores_request_errors(vc):
+    vc.session.get.side_effect = requests.ConnectionError("unreachable")
+    vc.warm_up()
@@ -13,11 +13,14 @@ from __future__ import annotations
 
 import argparse
 import logging
-import re
 import signal
+import string
 import sys
 import time
-from typing import Dict, Iterable, Optional
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import ExitStack
+from typing import Deque, Dict, Iterable, List, Optional, Tuple
 
 import requests
 import speech_recognition as sr
@@ -25,10 +28,37 @@ from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 
 
+_log = logging.getLogger(__name__)
+
 DEFAULT_ESP32_IP = "192.168.0.172"
 DEFAULT_AMBIENT_DURATION = 2.0
 DEFAULT_TIMEOUT = 5.0
+DEFAULT_WARMUP_TIMEOUT = 1.0
 DEFAULT_PAUSE = 0.1
+# Commands are a few words long, so end utterances after a short silence
+DEFAULT_PAUSE_THRESHOLD = 0.5
+DEFAULT_NON_SPEAKING_DURATION = 0.3
+DEFAULT_PHRASE_TIME_LIMIT = 4.0
+# 16 kHz is all Google's recognizer needs; higher rates only inflate the upload
+DEFAULT_SAMPLE_RATE = 16000
+
+# Natural-language fallback for bulk commands ("switch the lab all on")
+_SWITCH_VERBS = frozenset(("turn", "switch"))
+# Spoken word forms mapped onto the words used in command_map: plural
+# device nouns ("turn on lights") and common mishearings ("fan one")
+_WORD_ALIASES = {noun + "s": noun for noun in ("led", "light", "fan", "projector")}
+_WORD_ALIASES["one"] = "on"
+# Recognizer punctuation ("led on.") is dropped before matching; deleting
+# ASCII bytes is safe on UTF-8 and much cheaper than str.translate
+_PUNCTUATION_BYTES = string.punctuation.encode()
+
+# Bulk commands fan out to one request per device
+_ALL_ON = "all/on"
+_ALL_OFF = "all/off"
+_BULK: Dict[str, Tuple[str, ...]] = {
+    _ALL_ON: ("led/on", "light/on", "projector/on", "fan/on"),
+    _ALL_OFF: ("led/off", "light/off", "projector/off", "fan/off"),
+}
 
 
 def build_session(
@@ -46,12 +76,87 @@ def build_session(
         backoff_factor=0.3,
         status_forcelist=(500, 502, 503, 504)
     )
-    s.mount("http://", HTTPAdapter(max_retries=retry_strategy))
-    s.mount("https://", HTTPAdapter(max_retries=retry_strategy))
+    # One pooled connection per worker used to fan out bulk commands
+    s.mount("http://", HTTPAdapter(pool_maxsize=4, max_retries=retry_strategy))
+    s.mount("https://", HTTPAdapter(pool_maxsize=4, max_retries=retry_strategy))
     s.request_timeout = timeout  # type: ignore[attr-defined]
     return s
 
 
+def _tokenize(text: str) -> List[str]:
+    """
+    Split text into words with punctuation dropped and spoken variants
+    mapped onto the words used in command_map (see _WORD_ALIASES).
+    """
+    words = text.encode().translate(None, _PUNCTUATION_BYTES).decode().split()
+    return [_WORD_ALIASES.get(w, w) for w in words]
+
+
+def _match_bulk(tokens: List[str]) -> Tuple[int, Optional[str]]:
+    """
+    Match "turn/switch ... all ... on/off" with the words in that order.
+    The first on/off after "all" decides the command.
+    Returns the index of "all" (where the command counts as starting)
+    and the endpoint, or (len(tokens), None) if there is no match.
+    """
+    if "all" not in tokens:
+        return len(tokens), None
+    start = None
+    seen_verb = False
+    for i, token in enumerate(tokens):
+        if not seen_verb:
+            seen_verb = token in _SWITCH_VERBS
+        elif start is None:
+            if token == "all":
+                start = i
+        elif token == "on":
+            return start, _ALL_ON
+        elif token == "off":
+            return start, _ALL_OFF
+    return len(tokens), None
+
+
+class _CommandTrie:
+    """
+    Token-level prefix tree mapping command phrases to endpoints.
+    Each node is itself a _CommandTrie; the root holds no endpoint.
+    """
+
+    __slots__ = ("children", "endpoint")
+
+    def __init__(self) -> None:
+        self.children: Dict[str, _CommandTrie] = {}
+        self.endpoint: Optional[str] = None
+
+    def insert(self, phrase: str, endpoint: str) -> None:
+        node = self
+        for token in phrase.split():
+            node = node.children.setdefault(token, _CommandTrie())
+        # First insertion wins if the same phrase is listed twice
+        if node.endpoint is None:
+            node.endpoint = endpoint
+
+    def match(self, tokens: List[str], stop: Optional[int] = None) -> Optional[str]:
+        """
+        Return the endpoint of the leftmost phrase found in tokens,
+        considering only phrases that start before index stop.
+        When phrases overlap at the same start, the shortest one wins.
+        """
+        n = len(tokens)
+        roots = self.children
+        for i in range(n if stop is None else stop):
+            node = roots.get(tokens[i])
+            j = i + 1
+            while node is not None:
+                if node.endpoint is not None:
+                    return node.endpoint
+                if j == n:
+                    break
+                node = node.children.get(tokens[j])
+                j += 1
+        return None
+
+
 class VoiceController:
     """Handles voice recognition and device control."""
 
@@ -59,19 +164,33 @@ class VoiceController:
         self,
         esp32_ip: str,
         recognizer: Optional[sr.Recognizer] = None,
-        mic: Optional[sr.Microphone] = None
+        mic: Optional[sr.Microphone] = None,
+        sample_rate: Optional[int] = DEFAULT_SAMPLE_RATE
     ):
         self.esp32_ip = esp32_ip
-        self.recognizer = recognizer or sr.Recognizer()
-        self.mic = mic or sr.Microphone()
+        # Injected recognizers keep their own endpointing settings
+        self._phrase_time_limit: Optional[float] = None
+        if recognizer is None:
+            recognizer = sr.Recognizer()
+            recognizer.pause_threshold = DEFAULT_PAUSE_THRESHOLD
+            recognizer.non_speaking_duration = DEFAULT_NON_SPEAKING_DURATION
+            self._phrase_time_limit = DEFAULT_PHRASE_TIME_LIMIT
+        self.recognizer = recognizer
+        # None (or 0) keeps the device's default rate, which always opens;
+        # a fixed rate on our own microphone falls back to it in _open_mic
+        self._sample_rate = None if mic else sample_rate or None
+        self.mic = mic or sr.Microphone(sample_rate=self._sample_rate)
         self.session = build_session()
+        # Sized to match the session's connection pool
+        self._pool = ThreadPoolExecutor(max_workers=4)
+        self._inflight: Deque[Future] = deque()
         self.running = True
 
         # Map voice commands to ESP32 endpoints (relay wiring)
         # Relay Channel 1 (GPIO 32): Light
     # Relay Channel 2 (GPIO 33): Fan
     # Optional: Projector on GPIO 21 (Relay CH3)
-        # Order matters - more specific phrases should come first
+        # The leftmost phrase in an utterance wins, whatever the map order
         self.command_map: Dict[Iterable[str], str] = {
             ("turn everything on", "turn all on", "all on"): "all/on",
             ("turn everything off", "turn all off", "all off"): "all/off",
@@ -85,63 +204,119 @@ class VoiceController:
             ("projector off", "turn off projector"): "projector/off",
         }
 
+        # Full URLs for every known endpoint (bulk targets are in the map too)
+        self._urls: Dict[str, str] = {
+            ep: f"http://{esp32_ip}/{ep}" for ep in set(self.command_map.values())
+        }
+
+        # Built once: exact phrases resolve with one dict lookup, anything
+        # else is a single trie pass over the spoken words
+        self._exact: Dict[str, str] = {}
+        self._trie = _CommandTrie()
+        for phrases, endpoint in self.command_map.items():
+            for p in phrases:
+                self._exact.setdefault(p, endpoint)
+                self._trie.insert(p, endpoint)
+
     def _match_command(self, text: str) -> Optional[str]:
         """
         Try to match user's speech to a known command.
+        Caller must pass lowercased text (listen_once already does).
+        If several commands are spoken, the leftmost one wins
+        ("fan off and turn everything on" -> fan/off).
         Returns the endpoint path if found, None otherwise.
         """
-        text = text.lower()
-        
-        # Check direct substring matches first (handles extra words gracefully)
-        for phrases, endpoint in self.command_map.items():
-            for p in phrases:
-                if p in text:
-                    return endpoint
-        
-        # Fallback: regex patterns for natural variations
-        if re.search(r"\b(turn|switch) .* all .* on\b", text):
-            return "all/on"
-        if re.search(r"\b(turn|switch) .* all .* off\b", text):
-            return "all/off"
-        
-        return None
+        # Exact phrase is the common case ("led on")
+        endpoint = self._exact.get(text)
+        if endpoint:
+            return endpoint
+
+        # Tokenize once; the token passes below share the same word list
+        tokens = _tokenize(text)
+
+        # Natural bulk phrasing counts as starting at its "all", so a
+        # device phrase spoken before that still wins
+        start, bulk = _match_bulk(tokens)
+
+        # Walk the phrase trie (handles extra words, punctuation, aliases);
+        # this is the only scan over the words
+        return self._trie.match(tokens, start) or bulk
 
     def send_command(self, path: str) -> bool:
         """Send HTTP request to ESP32. Returns True if successful."""
-        url = f"http://{self.esp32_ip}/{path}"
+        url = self._urls.get(path) or f"http://{self.esp32_ip}/{path}"
         try:
-            logging.debug("Sending request to %s", url)
+            if _log.isEnabledFor(logging.DEBUG):
+                _log.debug("Sending request to %s", url)
             resp = self.session.get(url, timeout=DEFAULT_TIMEOUT)
             resp.raise_for_status()
-            logging.info("Command sent: %s (status=%s)", path, resp.status_code)
+            _log.info("Command sent: %s (status=%s)", path, resp.status_code)
             return True
         except requests.RequestException as exc:
-            logging.warning("Failed to send command %s: %s", path, exc)
+            _log.warning("Failed to send command %s: %s", path, exc)
             return False
 
-    def adjust_ambient(self, duration: float = DEFAULT_AMBIENT_DURATION) -> None:
-        """Calibrate microphone for background noise."""
-        logging.info("Calibrating microphone (%.1fs)...", duration)
-        with self.mic as source:
-            self.recognizer.adjust_for_ambient_noise(source, duration=duration)
+    def warm_up(self) -> None:
+        """Resolve the ESP32's address (ARP/DNS) before the first command."""
+        try:
+            self.session.get(f"http://{self.esp32_ip}/status", timeout=DEFAULT_WARMUP_TIMEOUT)
+            _log.debug("Reached %s during warm-up", self.esp32_ip)
+        except requests.RequestException as exc:
+            _log.debug("Warm-up request to %s failed: %s", self.esp32_ip, exc)
+
+    def _dispatch(self, path: str) -> None:
+        """Send a command in the background so listening can resume."""
+        self._inflight.append(self._pool.submit(self.send_command, path))
 
-    def listen_once(self) -> Optional[str]:
+    def _drain(self, wait: bool = False) -> None:
         """
-        Listen for one utterance and return the recognized text.
-        Returns None if speech wasn't understood or request failed.
+        Reap finished requests (outcomes are logged by send_command).
+        With wait=True, block until every in-flight request is done.
         """
-        with self.mic as source:
-            audio = self.recognizer.listen(source)
+        while self._inflight and (wait or self._inflight[0].done()):
+            self._inflight.popleft().result()
+
+    def _open_mic(self, stack: ExitStack) -> sr.AudioSource:
+        """Open the microphone, retrying at the device's default rate."""
+        try:
+            return stack.enter_context(self.mic)
+        except OSError as exc:
+            if self._sample_rate is None:
+                raise
+            _log.warning(
+                "Microphone can't record at %d Hz (%s); using the device default rate",
+                self._sample_rate, exc
+            )
+            self._sample_rate = None
+            self.mic = sr.Microphone(device_index=self.mic.device_index)
+            return stack.enter_context(self.mic)
+
+    def adjust_ambient(
+        self,
+        source: sr.AudioSource,
+        duration: float = DEFAULT_AMBIENT_DURATION
+    ) -> None:
+        """Calibrate an already-open microphone for background noise."""
+        _log.info("Calibrating microphone (%.1fs)...", duration)
+        self.recognizer.adjust_for_ambient_noise(source, duration=duration)
+
+    def listen_once(self, source: sr.AudioSource) -> Optional[str]:
+        """
+        Listen for one utterance on an already-open microphone and return
+        the recognized text.
+        Returns None if speech wasn't understood; raises sr.RequestError
+        if the recognition service couldn't be reached.
+        """
+        audio = self.recognizer.listen(
+            source, phrase_time_limit=self._phrase_time_limit
+        )
         
         try:
             text = self.recognizer.recognize_google(audio)
-            logging.info("Heard: %s", text)
+            _log.info("Heard: %s", text)
             return text.lower()
         except sr.UnknownValueError:
-            logging.debug("Couldn't understand that")
-            return None
-        except sr.RequestError as exc:
-            logging.error("Speech recognition service error: %s", exc)
+            _log.debug("Couldn't understand that")
             return None
 
     def run(
@@ -149,40 +324,78 @@ class VoiceController:
         ambient_duration: float = DEFAULT_AMBIENT_DURATION,
         pause: float = DEFAULT_PAUSE
     ) -> None:
-        """Main loop - listen for commands and execute them."""
-        logging.info("Starting voice controller (ESP32=%s)", self.esp32_ip)
-        self.adjust_ambient(ambient_duration)
-        logging.info("Ready - speak a command (Ctrl-C to exit)")
-
+        """
+        Main loop - listen for commands and execute them.
+        Can be called again after stop(); call close() when done.
+        """
+        _log.info("Starting voice controller (ESP32=%s)", self.esp32_ip)
+        self.running = True
+        # Resolve the ESP32's address in the background while the microphone
+        # calibrates. The firmware closes every connection, so no socket stays
+        # pooled; an unreachable ESP32 holds this worker for ~4 s of retries.
+        self._pool.submit(self.warm_up)
+        try:
+            # Keep one audio stream open for the whole session instead of
+            # reopening the device for every utterance
+            with ExitStack() as stack:
+                source = self._open_mic(stack)
+                self.adjust_ambient(source, ambient_duration)
+                _log.info("Ready - speak a command (Ctrl-C to exit)")
+                self._serve(source, pause)
+        finally:
+            # Let requests already sent finish, even if listening failed
+            self._drain(wait=True)
+
+    def _serve(self, source: sr.AudioSource, pause: float) -> None:
+        """Listen and dispatch commands until stop() is called."""
         while self.running:
-            text = self.listen_once()
-            if not text:
+            self._drain()
+            try:
+                text = self.listen_once(source)
+            except sr.RequestError as exc:
+                # Back off only when the service failed; listen() already blocks
+                _log.error("Speech recognition service error: %s", exc)
                 time.sleep(pause)
                 continue
+            if not text:
+                continue
 
             endpoint = self._match_command(text)
             if not endpoint:
                 continue
+
+            # Previous command's requests finished while we were listening;
+            # waiting here keeps commands applied in the order spoken
+            self._drain(wait=True)
             
             # Handle bulk commands by sending multiple requests
-            if endpoint == "all/on":
-                logging.info("Activating all devices")
-                for e in ("led/on", "light/on", "projector/on", "fan/on"):
-                    self.send_command(e)
-                    time.sleep(0.1)
-            elif endpoint == "all/off":
-                logging.info("Deactivating all devices")
-                for e in ("led/off", "light/off", "projector/off", "fan/off"):
-                    self.send_command(e)
-                    time.sleep(0.1)
+            targets = _BULK.get(endpoint)
+            if targets:
+                _log.info("Sending %s to all devices", endpoint)
+                for e in targets:
+                    self._dispatch(e)
             else:
-                self.send_command(endpoint)
+                self._dispatch(endpoint)
 
     def stop(self) -> None:
         """Stop the main loop gracefully."""
-        logging.info("Shutting down")
+        _log.info("Shutting down")
         self.running = False
 
+    def close(self) -> None:
+        """Wait for outstanding requests and release the worker threads."""
+        try:
+            self._drain(wait=True)
+        finally:
+            self._pool.shutdown()
+
+
+def _non_negative_int(value: str) -> int:
+    n = int(value)
+    if n < 0:
+        raise argparse.ArgumentTypeError(f"must be 0 or greater, got {n}")
+    return n
+
 
 def parse_args(argv: Optional[Iterable[str]] = None) -> argparse.Namespace:
     p = argparse.ArgumentParser(
@@ -199,6 +412,13 @@ def parse_args(argv: Optional[Iterable[str]] = None) -> argparse.Namespace:
         default=DEFAULT_AMBIENT_DURATION,
         help="Seconds to calibrate for ambient noise"
     )
+    p.add_argument(
+        "--sample-rate",
+        type=_non_negative_int,
+        default=DEFAULT_SAMPLE_RATE,
+        help="Microphone sample rate in Hz (0 = device default; falls back "
+             "to the default automatically if the device rejects it)"
+    )
     p.add_argument(
         "--verbose", "-v",
         action="store_true",
@@ -219,7 +439,7 @@ def main(argv: Optional[Iterable[str]] = None) -> int:
     args = parse_args(argv)
     setup_logging(args.verbose)
 
-    controller = VoiceController(args.ip)
+    controller = VoiceController(args.ip, sample_rate=args.sample_rate)
 
     def handle_interrupt(sig, frame):
         controller.stop()
@@ -229,8 +449,10 @@ def main(argv: Optional[Iterable[str]] = None) -> int:
     try:
         controller.run(ambient_duration=args.ambient)
     except Exception:
-        logging.exception("Unexpected error")
+        _log.exception("Unexpected error")
         return 2
+    finally:
+        controller.close()
     
     return 0
 